@@ -2,6 +2,14 @@
 
 SLEEP_INTERVAL = 0.1    # sleep serval seconds between crawling
 MAX_RETRIES = 10    # Number of times to retry a request
+MAX_WORKERS = 8    # Number of requests sent concurrently
+PAGE_INTERVAL = 0.05    # sleep seconds after a search page if weibo responds fast
+SLOW_RESPONSE = 0.5    # average response seconds above which the sleep after a page is skipped
+
+# response cache settings
+CACHE_NAME = ".weibo_cache"    # sqlite file of the cached responses
+CACHE_EXPIRE = 3600    # seconds before a cached response expires
+SEARCH_CACHE_EXPIRE = 300    # seconds before a cached search or user timeline page expires
 
 # weibo cookie
 cookie=""
@@ -1,9 +1,10 @@
 from weibo_crawler.weibo_crawler import WeiboCrawler
+from config import MAX_WORKERS
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
 
 result_dir = "search_result"
-if not os.path.exists(result_dir):
-    os.makedirs(result_dir)
 
 # 搜索关键词列表
 search_keywords_list = [
@@ -16,7 +17,28 @@ result_count_limit = 100
 start_time = "2022-06-01"
 end_time = "2022-08-31"
 
-crawl = WeiboCrawler()
-for keyword in search_keywords_list:
-    crawl.search_weibo(keyword, limit=result_count_limit, export_dir=result_dir, start_time=start_time,
-                       end_time=end_time)
+# 并行爬取的进程数, 过多容易被限制访问
+max_processes = 4
+
+
+def crawl_keywords(keywords, max_workers, **kwargs):
+    # 每个进程使用独立的爬虫, 各自维护会话, 依次爬取分到的关键词, 导出与下一个关键词的爬取重叠
+    with WeiboCrawler(max_workers=max_workers) as crawl:
+        for keyword in keywords:
+            crawl.search_weibo(keyword, **kwargs)
+
+
+if __name__ == "__main__":
+    if not os.path.exists(result_dir):
+        os.makedirs(result_dir)
+
+    # 没有关键词时无需启动进程
+    if search_keywords_list:
+        processes = min(max_processes, len(search_keywords_list))
+        # 所有进程的并发请求总数不超过 MAX_WORKERS
+        crawl_group = partial(crawl_keywords, max_workers=max(1, MAX_WORKERS // processes),
+                              limit=result_count_limit, export_dir=result_dir, start_time=start_time,
+                              end_time=end_time)
+        keyword_groups = [search_keywords_list[i::processes] for i in range(processes)]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            list(executor.map(crawl_group, keyword_groups))
@@ -1,57 +1,254 @@
+import math
 import os.path
 import time
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from operator import itemgetter
+import orjson
+import requests_cache
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 import pandas as pd
 import datetime
-import pytz
+from zoneinfo import ZoneInfo
 import warnings
+import ahocorasick
 
-from config import MAX_RETRIES, SLEEP_INTERVAL, headers, cookie
+from config import CACHE_EXPIRE, CACHE_NAME, MAX_RETRIES, MAX_WORKERS, PAGE_INTERVAL, SEARCH_CACHE_EXPIRE, \
+    SLEEP_INTERVAL, SLOW_RESPONSE, headers, cookie
 
 warnings.filterwarnings("ignore")
 
 retries = Retry(
     total=MAX_RETRIES,
     backoff_factor=SLEEP_INTERVAL,
-    status_forcelist=[403, 500, 502, 503, 504],
+    status_forcelist=[403, 429, 500, 502, 503, 504],  # 429 and 503 wait for Retry-After
 )
 
 # check cookie and join cookie in headers if not empty
 if cookie:
     headers["cookie"] = cookie
 
+# columns of the dataframe built from search results
+search_columns = [
+    'wid', 'user_name', 'user_id', 'gender', 'publish_time', 'text',
+    'like_count', 'comment_count', 'forward_count', 'origin_publish_time',
+]
+months = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+# card types without weibo, e.g. 7 导语
+skip_card_types = frozenset({7, 8})
+# fields of a mblog and its user, always present in a valid mblog
+mblog_getter = itemgetter('id', 'user', 'text', 'attitudes_count', 'comments_count', 'reposts_count', 'created_at',
+                          'isLongText')
+user_getter = itemgetter('screen_name', 'id', 'gender')
+count_units = {'万': 10000, '亿': 100000000}
+search_dtypes = {
+    'wid': 'string',
+    'user_id': 'Int64',
+    'gender': 'category',
+    'like_count': 'Int32',
+    'comment_count': 'Int32',
+    'forward_count': 'Int32',
+}
+
+
+@lru_cache(maxsize=None)
+def _utc_offset(offset):
+    """convert a "+HHMM" utc offset into a timezone, cached as weibo uses very few offsets"""
+    delta = datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+    return datetime.timezone(-delta if offset[0] == '-' else delta)
+
+
+def _parse_count(count):
+    """convert a weibo count into an int, popular weibo have counts like "100万+"
+
+    Args:
+        count (int or str): the count given by weibo
+
+    Returns:
+        int: the count, None if it can not be parsed
+    """
+    if count is None or isinstance(count, int):
+        return count
+    count = str(count).strip().rstrip('+')
+    unit = count_units.get(count[-1:], 1)
+    if unit != 1:
+        count = count[:-1]
+    try:
+        return int(float(count) * unit)
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=32)
+def _keyword_automaton(keywords):
+    """build an Aho-Corasick automaton matching any of the keywords, cached for repeated keyword lists"""
+    automaton = ahocorasick.Automaton()
+    for keyword in keywords:
+        automaton.add_word(keyword, keyword)
+    automaton.make_automaton()
+    return automaton
+
 
 class WeiboCrawler:
-    def __init__(self):
-        self.client = requests.Session()
-        self.client.mount("http://", HTTPAdapter(max_retries=retries))
-        self.client.mount("https://", HTTPAdapter(max_retries=retries))
+    _TZ_SH = ZoneInfo('Asia/Shanghai')
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        """create a crawler whose requests share one session
+
+        Args:
+            max_workers (int, optional): the number of requests sent concurrently. Defaults to MAX_WORKERS.
+        """
+        self.max_workers = max_workers
+        # cache GET responses on disk, reruns and resumed crawls skip the requests already done
+        self.client = requests_cache.CachedSession(
+            cache_name=CACHE_NAME,
+            backend="sqlite",
+            expire_after=CACHE_EXPIRE,
+            # paginated listings change as weibo is posted, only lookups like statuses/extend keep CACHE_EXPIRE
+            urls_expire_after={
+                "m.weibo.cn/api/container/getIndex": SEARCH_CACHE_EXPIRE,
+                "weibo.com/ajax/statuses/mymblog": SEARCH_CACHE_EXPIRE,
+            },
+            allowable_methods=("GET",),
+        )
+        # keep one kept-alive connection per worker thread, threads wait for a free one
+        # instead of opening connections which are thrown away after the request
+        adapter = HTTPAdapter(max_retries=retries, pool_maxsize=max_workers, pool_block=True)
+        self.client.mount("http://", adapter)
+        self.client.mount("https://", adapter)
+        # the session is shared by the worker threads, which fetch pages concurrently
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # exports run in the background, so the next crawl overlaps with the file writing
+        self._writer_pool = ThreadPoolExecutor(max_workers=1)
+        self._write_futures = []
+        # moving average of the response time of weibo in seconds, None before the first response,
+        # and whether the last search page came from the cache, only updated by the crawling thread
+        self._latency = None
+        self._last_from_cache = False
 
         self.weibo_datetime_format = "%a %b %d %H:%M:%S %z %Y"
         self.datetime_format = "%Y-%m-%d"
 
-    def search_weibo(self, keyword, limit=100, export_dir=".", start_time="", end_time=""):
-        page = 0
-        weibo_df = pd.DataFrame()
-        while True:
-            time.sleep(0.1)
-            page += 1
-            search_result = self._get_search_result(keyword, page)
+    def search_weibo(self, keyword, limit=100, export_dir=".", start_time="", end_time="", export_format="parquet"):
+        """search weibo by keyword and export the result to export_dir
+
+        Args:
+            keyword (str): the search keyword
+            limit (int, optional): the maximum number of weibo. Defaults to 100.
+            export_dir (str, optional): the directory of the exported file. Defaults to ".".
+            start_time (str, optional): the start date, format:"YYYY-MM-DD". Defaults to "", no bound.
+            end_time (str, optional): the end date, format:"YYYY-MM-DD". Defaults to "", no bound.
+            export_format (str, optional): "parquet" or "xlsx". Defaults to "parquet".
+
+            the export runs in the background, call close() or use the crawler as a context manager
+            to wait for it, export errors are only raised there.
+
+        Returns:
+            pd.DataFrame: the weibo found
+        """
+        next_page = 1
+        parsed_pages = 0
+        page_frames = []
+        weibo_count = 0
+        in_flight = deque()  # futures of the requested pages, in page order
+        get_search_response = partial(self._get_search_response, keyword)
+        start_dt, end_dt = self._parse_bounds(start_time, end_time)
+        while weibo_count < limit:
+            # keep as many pages in flight as the remaining weibo are expected to need
+            while len(in_flight) < self._pages_needed(limit - weibo_count, weibo_count, parsed_pages):
+                self._pace()
+                in_flight.append(self.executor.submit(get_search_response, next_page))
+                next_page += 1
+            response = in_flight.popleft().result()
+            self._update_latency(response)
+            search_result = orjson.loads(response.content)
             if not len(search_result.get('data').get('cards')):
                 break
-            temp_weibo_df = self._parse_search_result(search_result, start_time, end_time)
-            weibo_df = weibo_df.append(temp_weibo_df)
+            temp_weibo_df = self._parse_search_result(search_result, start_dt, end_dt,
+                                                      max_items=limit - weibo_count)
+            page_frames.append(temp_weibo_df)
+            weibo_count += len(temp_weibo_df)
+            parsed_pages += 1
+        # the pages requested ahead are not needed any more
+        for future in in_flight:
+            future.cancel()
 
-            if not weibo_df.empty:
-                export_path = os.path.join(export_dir, keyword + ".xlsx")
-                weibo_df.to_excel(export_path)
+        if page_frames:
+            weibo_df = pd.concat(page_frames, ignore_index=True)
+        else:
+            weibo_df = pd.DataFrame(columns=search_columns)
+            weibo_df['publish_time'] = self._to_publish_time(weibo_df['origin_publish_time'])
+        weibo_df = weibo_df.astype(search_dtypes)
 
-            if len(weibo_df) > limit:
-                break
+        # export once after all pages are crawled
+        if not weibo_df.empty:
+            # export a copy, so changes of the caller to the returned dataframe do not race with the writing
+            export_path = os.path.join(export_dir, keyword)
+            future = self._writer_pool.submit(self._export, weibo_df.copy(), export_path, export_format)
+            self._write_futures.append(future)
+        return weibo_df
+
+    def _pages_needed(self, remaining, weibo_count, parsed_pages):
+        """estimate how many pages to keep in flight from the weibo kept per page so far
+
+        Args:
+            remaining (int): the number of weibo still needed
+            weibo_count (int): the number of weibo kept so far
+            parsed_pages (int): the number of pages parsed so far
+
+        Returns:
+            int: the number of pages, between 1 and max_workers
+        """
+        if not parsed_pages:
+            return 1
+        if not weibo_count:
+            return self.max_workers
+        return max(1, min(self.max_workers, math.ceil(remaining * parsed_pages / weibo_count)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    def _get_search_result(self, keyword, page):
+    def close(self):
+        """wait for the background exports to finish and release the thread pools and the session
+
+        Raises:
+            Exception: the first error raised by a background export
+        """
+        self._writer_pool.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+        self.client.close()
+        write_futures, self._write_futures = self._write_futures, []
+        for future in write_futures:
+            future.result()
+
+    @staticmethod
+    def _export(weibo_df, export_path, export_format):
+        """export the dataframe to export_path with the extension of export_format
+
+        Args:
+            weibo_df (pd.DataFrame): the weibo info to export
+            export_path (str): the export path without extension
+            export_format (str): "parquet" or "xlsx"
+        """
+        if export_format == "parquet":
+            weibo_df.to_parquet(export_path + ".parquet", engine="pyarrow", compression="zstd", index=False)
+        elif export_format == "xlsx":
+            # excel does not support timezone aware datetimes
+            weibo_df = weibo_df.assign(publish_time=weibo_df['publish_time'].dt.tz_localize(None))
+            weibo_df.to_excel(export_path + ".xlsx", index=False, engine="openpyxl")
+        else:
+            raise ValueError("unsupported export format: {}".format(export_format))
+
+    def _get_search_response(self, keyword, page):
         url = f"https://m.weibo.cn/api/container/getIndex"
         params = {
             "containerid": "100103type=61&q={}".format(keyword),
@@ -59,12 +256,37 @@ class WeiboCrawler:
             "page": page
         }
         response = self.client.get(url, params=params)
-        if response.status_code == 200:
-            response = response.json()
-        else:
+        if response.status_code != 200:
             raise ValueError("{}访问状态: {}".format(url, response.status_code))
         return response
 
+    def _update_latency(self, response):
+        """record how weibo responded to a search page, used by _pace
+
+        Args:
+            response (requests.Response): the response of a search page
+        """
+        self._last_from_cache = response.from_cache
+        if response.from_cache:
+            return
+        elapsed = response.elapsed.total_seconds()
+        if self._latency is None:
+            self._latency = elapsed
+        else:
+            self._latency = 0.8 * self._latency + 0.2 * elapsed
+
+    def _pace(self):
+        """pause before requesting the next search page according to how weibo is responding
+
+        Nothing is known before the first response and cached pages need no pause, a slow weibo
+        already spaces the requests out, otherwise wait PAGE_INTERVAL.
+        Throttling (429 with Retry-After) is waited out by the retry adapter.
+        """
+        if self._latency is None or self._last_from_cache:
+            return
+        if self._latency < SLOW_RESPONSE:
+            time.sleep(PAGE_INTERVAL)
+
     def _get_long_text(self, id):
         params = {
             'id': id
@@ -72,55 +294,95 @@ class WeiboCrawler:
         url = "https://m.weibo.cn/statuses/extend"
         response = self.client.get(url, params=params)
         if response.status_code == 200:
-            response = response.json()
+            response = orjson.loads(response.content)
         else:
             raise ValueError("{}访问状态: {}".format(url, response.status_code))
         data = response.get('data')
         return data.get("longTextContent")
 
-    def _parse_search_result(self, search_result, start_time="", end_time=""):
-        weibo_df = pd.DataFrame()
+    def _parse_search_result(self, search_result, start_dt=None, end_dt=None, max_items=None):
+        rows = []
+        pending_long = []  # (row index, weibo id) of long weibo
         items = search_result.get('data').get('cards')
-        if not len(items):
-            return weibo_df
-        for index, item in enumerate(items):
-            if item.get('card_type') == 7:  # 导语
+        get = dict.get
+        for item in items:
+            card_type = get(item, 'card_type')
+            card_group = get(item, 'card_group')
+            if card_type in skip_card_types or (card_type == 11 and card_group is None):
                 continue
-            elif item.get('card_type') == 8 or (item.get('card_type') == 11 and item.get('card_group') is None):
-                continue
-            if item.get('mblog', None):
-                item = item.get('mblog')
-            else:
-                item = item.get('card_group')[0].get('mblog')
+            item = get(item, 'mblog') or get(card_group[0], 'mblog')
             if item:
-                # 检查是否在要求的时间区间内
-                if not self.check_time(start_time, end_time, item.get('created_at')):
-                    continue
-
-                publish_time = self._str2datetime(item.get('created_at'), self.weibo_datetime_format).replace(tzinfo=None)
+                wid, user, text, like_count, comment_count, forward_count, created_at, is_long_text = mblog_getter(item)
+                user_name, user_id, gender = user_getter(user)
                 data = {
-                    'wid': item.get('id'),
-                    'user_name': item.get('user').get('screen_name'),  # 用户昵称
-                    'user_id': item.get('user').get('id'),  # 用户id
-                    'gender': item.get('user').get('gender'),  # 用户性别
-                    'publish_time': publish_time,  # 发布时间
-                    'text': item.get("text"),  # 仅提取内容中的文本
-                    'like_count': item.get('attitudes_count'),  # 点赞数
-                    'comment_count': item.get('comments_count'),  # 评论数
-                    'forward_count': item.get('reposts_count'),  # 转发数
-                    'origin_publish_time': item.get('created_at'),  # 原发布时间
+                    'wid': wid,
+                    'user_name': user_name,  # 用户昵称
+                    'user_id': user_id,  # 用户id
+                    'gender': gender,  # 用户性别
+                    'text': text,  # 仅提取内容中的文本
+                    'like_count': _parse_count(like_count),  # 点赞数
+                    'comment_count': _parse_count(comment_count),  # 评论数
+                    'forward_count': _parse_count(forward_count),  # 转发数
+                    'origin_publish_time': created_at,  # 原发布时间
                 }
-                if item.get('isLongText'):
-                    long_text = self._get_long_text(item.get('id'))  # 获取长文本
-                    data["text"] = long_text
+                if is_long_text:
+                    pending_long.append((len(rows), wid))
 
-                weibo_df = weibo_df.append(data, ignore_index=True)
-        return weibo_df
+                rows.append(data)
+
+        weibo_df = pd.DataFrame(rows, columns=search_columns)
+        weibo_df['publish_time'] = self._to_publish_time(weibo_df['origin_publish_time'])
+
+        # 检查是否在要求的时间区间内, compared for the whole page at once
+        in_range = pd.Series(True, index=weibo_df.index)
+        if start_dt is not None:
+            in_range &= weibo_df['publish_time'] >= start_dt
+        if end_dt is not None:
+            in_range &= weibo_df['publish_time'] <= end_dt
+        # only keep the weibo still needed, so no long text is fetched for the rest
+        if max_items is not None:
+            in_range &= in_range.cumsum() <= max_items
+
+        # 并发获取时间区间内的长文本
+        pending_long = [(index, wid) for index, wid in pending_long if in_range[index]]
+        if pending_long:
+            indexes, ids = zip(*pending_long)
+            weibo_df.loc[list(indexes), 'text'] = list(self.executor.map(self._get_long_text, ids))
+        return weibo_df.loc[in_range].reset_index(drop=True)
+
+    def _to_publish_time(self, origin_publish_time):
+        """parse a column of weibo created_at strings in one call
+
+        Args:
+            origin_publish_time (pd.Series): the created_at of the weibo
+
+        Returns:
+            pd.Series: the publish time in Asia/Shanghai
+        """
+        return pd.to_datetime(
+            origin_publish_time, format=self.weibo_datetime_format, utc=True
+        ).dt.tz_convert(self._TZ_SH.key)
 
     @staticmethod
     def _str2datetime(string, datetime_format):
         return datetime.datetime.strptime(string, datetime_format)
 
+    @staticmethod
+    def _parse_weibo_datetime(string):
+        """parse the fixed layout weibo time, e.g. "Mon Jun 10 12:34:56 +0800 2024",
+        equal to strptime with weibo_datetime_format but much faster
+
+        Args:
+            string (str): the created_at of a weibo
+
+        Returns:
+            datetime.datetime: the timezone aware publish time
+        """
+        _, month, day, clock, offset, year = string.split()
+        hour, minute, second = clock.split(':')
+        return datetime.datetime(int(year), months[month], int(day), int(hour), int(minute), int(second),
+                                 tzinfo=_utc_offset(offset))
+
     def get_uid(self, nickname: str) -> int:
         """get uid by nickname
 
@@ -136,23 +398,34 @@ class WeiboCrawler:
             print("Error: {}".format(r.status_code))
             raise ValueError(f"{nickname} is not a weibo user name or weibo has a bad response")
         else:
-            return r.json()["data"]["uid"]
+            return orjson.loads(r.content)["data"]["uid"]
 
-    def check_time(self, start_time, end_time, weibo_time):
-        check_result = True
-        weibo_time = datetime.datetime.strptime(weibo_time, self.weibo_datetime_format)
+    def _parse_bounds(self, start_time, end_time):
+        """parse the time bounds of a crawl once, so rows only parse their own time
 
-        if start_time:
-            start_time = datetime.datetime.strptime(start_time, self.datetime_format)
-            start_time = start_time.replace(tzinfo=pytz.timezone('Asia/Shanghai'))
-            if weibo_time < start_time:
-                check_result = False
+        Args:
+            start_time (str): the start date, format:"YYYY-MM-DD", empty for no bound
+            end_time (str): the end date, format:"YYYY-MM-DD", empty for no bound
 
+        Returns:
+            tuple: (start datetime or None, end datetime or None) in Asia/Shanghai
+        """
+        start_dt = end_dt = None
+        if start_time:
+            start_dt = self._str2datetime(start_time, self.datetime_format).replace(tzinfo=self._TZ_SH)
         if end_time:
-            end_time = datetime.datetime.strptime(end_time, self.datetime_format)
-            end_time = end_time.replace(tzinfo=pytz.timezone('Asia/Shanghai'))
-            if weibo_time > end_time:
-                check_result = False
+            end_dt = self._str2datetime(end_time, self.datetime_format).replace(tzinfo=self._TZ_SH)
+        return start_dt, end_dt
+
+    def check_time(self, start_dt, end_dt, weibo_time):
+        check_result = True
+        weibo_time = self._parse_weibo_datetime(weibo_time)
+
+        if start_dt and weibo_time < start_dt:
+            check_result = False
+
+        if end_dt and weibo_time > end_dt:
+            check_result = False
 
         return check_result
 
@@ -161,7 +434,7 @@ class WeiboCrawler:
         """check if the text contains one of the keywords
 
         Args:
-            keyword_list (list): keywords list
+            keyword_list (list): keywords list, pass a frozenset when checking many texts to build it only once
             text (str): raw text of weibo
 
         Returns:
@@ -169,19 +442,21 @@ class WeiboCrawler:
         """
         if not keyword_list:
             return True
-        else:
-            for keyword in keyword_list:
-                if keyword in text:
-                    return True
-            return False
+        keywords = frozenset(keyword_list)  # no copy if keyword_list is already a frozenset
+        # an empty keyword is contained in every text, the automaton would drop it
+        if "" in keywords:
+            return True
+        automaton = _keyword_automaton(keywords)
+        return next(automaton.iter(text), None) is not None
 
-    def get_weibo_by_uid(self, uid: int, start: str = None, end: str = None) -> pd.DataFrame:
+    def get_weibo_by_uid(self, uid: int, start: str = None, end: str = None, keyword_list: list = None) -> pd.DataFrame:
         """get weibo info by uid
 
         Args:
             uid (int): the uid of the weibo user
             start (str, optional): the start date, format:"YYYY-MM-DD", for example: "2022-01-01". Defaults to None.
             end (str, optional): the end date, format:"YYYY-MM-DD", for example: "2022-03-01". Defaults to None.
+            keyword_list (list, optional): only keep the weibo containing one of the keywords. Defaults to None.
             
             if start and end are None, the default is crawl all the weibo of the user.
 
@@ -193,19 +468,21 @@ class WeiboCrawler:
         """
         page = 1
         weibo_info = ["user_id", "id", "微博正文", "发布时间", "点赞数", "评论数", "转发数"]
+        start_dt, end_dt = self._parse_bounds(start, end)
+        keywords = frozenset(keyword_list) if keyword_list else None
         while True:
             # get weibo by uid and page
             try:
                 url = "https://weibo.com/ajax/statuses/mymblog?uid={}&page={}&feature=0".format(uid, page)
-                response = self.client.get(url, headers=headers).json()
+                response = orjson.loads(self.client.get(url, headers=headers).content)
             except Exception as e:
                 raise e
 
             if not response["data"]["list"]:
-                weibo_df = pd.DataFrame(columns=weibo_info)
                 yield None
+                return
             else:
-                weibo_df = pd.DataFrame(columns=weibo_info)
+                rows = []
                 for item in response["data"]["list"]:
                     weibo = {
                         "user_id": item["user"]["id"],
@@ -216,7 +493,8 @@ class WeiboCrawler:
                         "评论数": item["comments_count"],
                         "转发数": item["reposts_count"],
                     }
-                    if self.check_time(start, end, weibo) and self.check_keyword_list(keyword_list, weibo):
-                        weibo_df = weibo_df.append(weibo, ignore_index=True)
+                    if self.check_time(start_dt, end_dt, weibo["发布时间"]) and \
+                            self.check_keyword_list(keywords, weibo["微博正文"]):
+                        rows.append(weibo)
                 page += 1
-                yield weibo_df
+                yield pd.DataFrame(rows, columns=weibo_info)